@@ -1,7 +1,16 @@
+import array
 import evdev
+import os
+import select
+import struct
 from logger import Logger
 import logging
 
+# struct input_event: struct timeval time; __u16 type; __u16 code; __s32 value;
+INPUT_EVENT = struct.Struct("llHHi")
+# Maximum number of events read from the device with a single read()
+READ_BATCH = 64
+
 
 class InputDeviceReader:
     def __init__(self, device_path=None):
@@ -14,58 +23,111 @@ class InputDeviceReader:
             filehandler=True,
         )
         # If no device path is specified, use the first device in the list
-        try:
+        if device_path is None:
+            device_path = self.first_device_path()
             if device_path is None:
-                devices = self.list_devices()
-                device_path = evdev.InputDevice(devices[0].path)
-        except IndexError:
-            raise Exception("No input devices found")
+                raise Exception("No input devices found")
         self.device = evdev.InputDevice(device_path)
 
-        # Initialize key states
-        self.key_states = {2: 0, 5: 0, 0: 0}
+        # Checked once, so the per-event debug message is not built when disabled.
+        self._dbg = self.logger.log.isEnabledFor(logging.DEBUG)
+
+        # Initialize key states, indexed by event code. KEY_CNT covers both
+        # button (EV_KEY) and analog (EV_ABS) codes.
+        self.key_states = array.array("i", [0] * evdev.ecodes.KEY_CNT)
+
+        # Precomputed percentage lookup tables for analog inputs.
+        # These are the max values for analog inputs on the XBOX One controller (M1142084-007).
+        self._joystick_max = joystick_max = 32767
+        self._trigger_max = trigger_max = 1023
+        self._joy_lut = array.array(
+            "b", [-int((v / joystick_max) * 100) for v in range(-32768, 32768)]
+        )
+        self._trig_lut = array.array(
+            "b", [int((v / trigger_max) * 100) for v in range(trigger_max + 1)]
+        )
+        # Kind of each ABS code: 1 for joysticks, 2 for triggers, 0 for others.
+        self._kind = [0] * evdev.ecodes.ABS_CNT
+        for code in (0, 1, 3, 4):  # Left X, Left Y, Right X, Right Y
+            self._kind[code] = 1
+        for code in (2, 5):  # Left Trigger, Right Trigger
+            self._kind[code] = 2
 
     def read_events(self, callback):
-        for event in self.device.read_loop():
-            # EV_KEY is for buttons
-            if event.type == evdev.ecodes.EV_KEY:
-                key_event = evdev.categorize(event)
-                key_number = key_event.scancode
-                key_name = key_event.keycode
-                key_value = key_event.keystate
-                percentage = None
-                # key_press = callback("key", key_number, key_value)
-            # EV_ABS is for analog inputs
-            if event.type == evdev.ecodes.EV_ABS:
-                abs_event = evdev.categorize(event)
-                key_number = abs_event.event.code
-                key_value = abs_event.event.value
-                percentage = self.value_to_percentage(key_number, key_value)
-                # key_press = callback("abs", key_number, key_value, percentage)
+        # Bind constants and methods used per event to local names once.
+        EV_SYN = evdev.ecodes.EV_SYN
+        EV_KEY = evdev.ecodes.EV_KEY
+        EV_ABS = evdev.ecodes.EV_ABS
+        SYN_REPORT = evdev.ecodes.SYN_REPORT
+        iter_unpack = INPUT_EVENT.iter_unpack
+        value_to_percentage = self.value_to_percentage
+        key_states = self.key_states
+        log_debug = self.logger.log.debug
+        dbg = self._dbg
+        fd = self.device.fd
+        # Events are read into the same buffer on every read, no per-read allocation.
+        buffer = bytearray(INPUT_EVENT.size * READ_BATCH)
+        view = memoryview(buffer)
 
-            # use key percentage if it is not None, otherwise use key value
-            self.logger.log.debug(
-                f"KeyNumber: {key_number} Value: {key_value} Percentage: {percentage}%"
-            )
-            self.key_states[key_number] = percentage or key_value
-            # self.key_states[key_number] = key_value
-            # callback("abs", key_number, key_value, percentage)
-            callback(self.key_states)
+        # The device fd is opened non-blocking by evdev. On every wakeup, drain
+        # all pending events and only call back once per drained buffer, after
+        # a full input frame (SYN_REPORT) has been seen. This way the callback
+        # always gets the latest state instead of a backlog of stale values.
+        while True:
+            select.select([fd], [], [])
+            frame_ready = False
+            while True:
+                try:
+                    size = os.readv(fd, [buffer])
+                except BlockingIOError:
+                    break
+                for _sec, _usec, event_type, key_number, key_value in iter_unpack(
+                    view[:size]
+                ):
+                    if event_type == EV_SYN:
+                        if key_number == SYN_REPORT:
+                            frame_ready = True
+                        continue
+                    # EV_KEY is for buttons
+                    if event_type == EV_KEY:
+                        percentage = None
+                    # EV_ABS is for analog inputs
+                    elif event_type == EV_ABS:
+                        percentage = value_to_percentage(key_number, key_value)
+                    else:
+                        continue
 
-    # Returns analog values as percentages
-    def value_to_percentage(self, key_number, key_value):
-        joysticks = [0, 1, 3, 4]  # Left X, Left Y, Right X, Right Y
-        triggers = [2, 5]  # Left Trigger, Right Trigger
+                    # use key percentage if it is not None, otherwise use key value
+                    if dbg:
+                        log_debug(
+                            "KeyNumber: %d Value: %d Percentage: %s%%",
+                            key_number,
+                            key_value,
+                            percentage,
+                        )
+                    key_states[key_number] = (
+                        percentage if percentage is not None else key_value
+                    )
+            if frame_ready:
+                callback(key_states)
 
-        # These are the max values for analog inputs on the XBOX One controller (M1142084-007).
-        joystick_max = 32767
-        trigger_max = 1023
+    # Returns analog values as percentages, or None for other analog inputs
+    def value_to_percentage(self, key_number, key_value):
+        kind = self._kind[key_number]
+        # Values outside the table range (other controllers) use the formula
+        if kind == 1:
+            if -32768 <= key_value <= 32767:
+                return self._joy_lut[key_value + 32768]
+            return int((key_value / self._joystick_max) * 100) * -1
+        elif kind == 2:
+            if 0 <= key_value <= self._trigger_max:
+                return self._trig_lut[key_value]
+            return int((key_value / self._trigger_max) * 100)
+        return None
 
-        if key_number in joysticks:
-            percentage = int((key_value / joystick_max) * 100) * -1
-        elif key_number in triggers:
-            percentage = int((key_value / trigger_max) * 100)
-        return percentage
+    # Returns the path of the first input device without opening any devices
+    def first_device_path(self):
+        return next(iter(evdev.list_devices()), None)
 
     def list_devices(self):
         devices = [evdev.InputDevice(path) for path in evdev.list_devices()]
@@ -32,17 +32,32 @@ class Logger:
 
         self.log = logging.getLogger(module_name)
         self.log.setLevel(log_level)
+        # Handlers are attached here, so don't pass records on to the root logger.
+        self.log.propagate = False
 
         # Only root level logger should delete old log file.
         if module_name == "__main__" and delete_old_logfile:
             self.delete_old_logfile()
 
         # Finally create the handlers and the class is ready to be used.
-        if filehandler:
+        # logging.getLogger returns the same logger for the same module name, so
+        # reuse handlers from earlier instances instead of adding duplicates.
+        if filehandler and not self.has_file_handler():
             self.create_file_handler()
-        if streamhandler:
+        if streamhandler and not self.has_stream_handler():
             self.create_stream_handler()
 
+    def has_file_handler(self):
+        log_file = os.path.abspath(self.log_file)
+        return any(
+            isinstance(h, logging.FileHandler) and h.baseFilename == log_file
+            for h in self.log.handlers
+        )
+
+    def has_stream_handler(self):
+        # FileHandler is a subclass of StreamHandler, so check the exact type.
+        return any(type(h) is logging.StreamHandler for h in self.log.handlers)
+
     def create_file_handler(self):
         formatter = logging.Formatter(
             fmt="[%(asctime)s]-[%(name)s]-[%(levelname)s]: %(message)s",
@@ -2,11 +2,13 @@ from rover import Rover
 from logger import Logger
 import logging
 from inputDeviceReader import InputDeviceReader
+import os
+import signal
 import threading
 
 
 class Main:
-    def __init__(self):
+    def __init__(self, reader_cpu=3, writer_cpu=2, realtime_priority=20):
         self.logger = Logger(
             module_name=__name__,
             log_level=logging.DEBUG,
@@ -19,13 +21,75 @@ class Main:
         self.rover = Rover()
         self.reader = InputDeviceReader()
 
+        # Single-slot mailbox between the reader and writer threads. The reader
+        # overwrites it with the newest key states, so the writer never sends
+        # stale states and slow serial I/O never blocks the input device.
+        self._state_cond = threading.Condition()
+        self._latest_state = None
+
+        # CPUs and SCHED_FIFO priority for the input reader thread and the writer
+        # side (state writer and the rover's serial writer thread).
+        # Set a CPU to None to leave that thread's affinity unchanged.
+        self.reader_cpu = reader_cpu
+        self.writer_cpu = writer_cpu
+        self.realtime_priority = realtime_priority
+
     def start(self):
-        # thread = threading.Thread(
-        #     target=self.reader.read_events, args=(self.rover.process_input_data,)
-        # )
-        # thread.start()
+        writer = threading.Thread(target=self.write_states, daemon=True)
+        writer.start()
+        self.pin_thread("state writer", writer.native_id, self.writer_cpu)
+        # The thread that actually writes to the UART
+        self.pin_thread(
+            "serial writer", self.rover.writer_thread.native_id, self.writer_cpu
+        )
+
+        # The input reader runs on the calling thread
+        self.pin_thread("input reader", threading.get_native_id(), self.reader_cpu)
+        self.reader.read_events(self.publish_state)
+
+    def pin_thread(self, name, thread_id, cpu):
+        # On Linux, these calls take a thread id and only apply to that thread.
+        if cpu is not None:
+            if cpu in os.sched_getaffinity(thread_id):
+                os.sched_setaffinity(thread_id, {cpu})
+                self.logger.log.info(f"Pinned {name} thread to CPU {cpu}")
+            else:
+                self.logger.log.warning(f"CPU {cpu} not available for {name} thread")
+        try:
+            os.sched_setscheduler(
+                thread_id, os.SCHED_FIFO, os.sched_param(self.realtime_priority)
+            )
+            self.logger.log.info(
+                f"Running {name} thread with SCHED_FIFO priority {self.realtime_priority}"
+            )
+        except PermissionError:
+            self.logger.log.warning(
+                f"No permission to set realtime priority for {name} thread"
+            )
+
+    def publish_state(self, key_states):
+        with self._state_cond:
+            # Slicing an array copies it in one go
+            self._latest_state = key_states[:]
+            self._state_cond.notify()
 
-        self.reader.read_events(self.rover.process_input_state)
+    def write_states(self):
+        while True:
+            with self._state_cond:
+                self._state_cond.wait_for(lambda: self._latest_state is not None)
+                state, self._latest_state = self._latest_state, None
+            try:
+                self.rover.process_input_state(state)
+            except Exception:
+                self.logger.log.exception("Could not process input state, stopping")
+                try:
+                    self.rover.emergency_stop()
+                except Exception:
+                    # The rover can't be controlled anymore, so stop the program.
+                    # SIGINT raises KeyboardInterrupt in the blocked reader thread.
+                    self.logger.log.exception("Could not stop the rover, exiting")
+                    os.kill(os.getpid(), signal.SIGINT)
+                    return
 
 
 if __name__ == "__main__":
@@ -1,6 +1,9 @@
-import time
+import collections
+import os
+import selectors
+import threading
 import serial
-import json
+import orjson
 from logger import Logger
 import logging
 
@@ -21,10 +24,45 @@ class Rover:
         self.ser = serial.Serial(port, baudrate)
         self.MAX_SPEED = 255
 
-    def read_data(self):
-        if self.ser.isOpen():
-            return self.ser.read_all().decode().strip()
-            # return self.ser.readline().decode().strip()
+        # Pre-encoded templates for frequently sent commands, so the hot paths
+        # skip building a dict and serializing it. They are only used for int
+        # values, other values are serialized as given. Every command sent to
+        # the device is terminated with a newline.
+        self._tmpl_speed = b'{"T":1,"L":%d,"R":%d}\n'
+        self._tmpl_pwm_servo = b'{"T":40,"pos":%d,"spd":%d}\n'
+        self._tmpl_oled = b'{"T":3,"lineNum":%d,"Text":%s}\n'
+        # All four OLED lines cleared with a single write.
+        self._oled_clear_bytes = b"".join(
+            self._tmpl_oled % (line, b'""') for line in range(4)
+        )
+
+        # Last written values of repeated commands, recorded by the writer thread
+        # once the write succeeded, and the newest queued item per value key.
+        # Used to skip redundant sends. Wheel speeds within SPEED_DEADBAND of
+        # the last speeds are skipped. A value of None means unknown.
+        self._last = {}
+        self._pending = {}
+        self.SPEED_DEADBAND = 2
+
+        # Outgoing commands are written by a dedicated writer thread, so callers
+        # never wait for the UART. Responses are picked up by a reader thread.
+        # Queued items are (coalesce_key, payload, sent_values) tuples, where
+        # sent_values is a tuple of (key, value) pairs to record once written.
+        self._outgoing = collections.deque()
+        self._outgoing_cond = threading.Condition()
+        self._closing = False
+        self.OUTGOING_MAX = 8
+        self.WRITE_BATCH_BYTES = 256
+        self._request_lock = threading.Lock()
+        self._response_lock = threading.Lock()
+        self._response_ready = threading.Event()
+        self._response = None
+        # Keys the awaited response must contain, None when no request is waiting
+        self._expected_keys = None
+        self.writer_thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.reader_thread = threading.Thread(target=self._read_loop, daemon=True)
+        self.writer_thread.start()
+        self.reader_thread.start()
 
     # def process_input_data(self, key_type, key_number, key_value, percentage=None):
     def process_input_data(self, key_type, key_number, key_value, percentage=None):
@@ -44,7 +82,9 @@ class Rover:
         self.speed_input(speed, speed)
 
     def process_input_state(self, key_states):
-        self.logger.log.debug(f"Key states: {key_states}")
+        self.logger.log.debug(
+            f"Key states: X: {key_states[0]} LT: {key_states[2]} RT: {key_states[5]}"
+        )
         speed = 0
         speed_reduction_left = 1
         speed_reduction_right = 1
@@ -93,40 +133,192 @@ class Rover:
         #     self.speed_input(speed, speed)
 
     def close_connection(self):
+        # Let the writer thread flush all queued commands before closing the port.
+        with self._outgoing_cond:
+            self._closing = True
+            self._outgoing_cond.notify_all()
+        self.writer_thread.join()
+        self.reader_thread.join()
         if self.ser.isOpen():
             self.ser.close()
 
-    def send_json(self, data, wait_for_response=False):
-        if self.ser.isOpen():
-            json_data = json.dumps(data)
-            self.logger.log.debug(f"Sending JSON command: {json_data}")
-            self.ser.write(json_data.encode())
-            if wait_for_response:
-                time.sleep(0.1)  # give the device time to respond
-                response = self.ser.readline().decode().strip()
-
-                try:
-                    response_json = json.loads(response)
-                except:
-                    self.logger.log.error(f"Could not parse JSON response: {response}")
-                    return None
-                self.logger.log.debug(f"Command response: {response_json}")
-                return response_json
+    def send_json_fire_and_forget(self, data, sent_values=()):
+        self.send_bytes_fire_and_forget(
+            orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE),
+            sent_values=sent_values,
+        )
+
+    def send_bytes_fire_and_forget(self, payload, coalesce_key=None, sent_values=()):
+        # payload must be one or more newline-terminated JSON commands
+        self.logger.log.debug("Sending JSON command: %s", payload)
+        self._enqueue(payload, coalesce_key, sent_values)
+
+    def _last_value(self, key):
+        # Newest queued value for key, or the last written one if none is queued.
+        # Queued commands are never dropped, so this is what the device ends up with.
+        with self._outgoing_cond:
+            pending = self._pending.get(key)
+            if pending is not None:
+                return pending[1]
+            return self._last.get(key)
+
+    def send_json_request(self, data, timeout=1.0, expected_keys=()):
+        """
+        Send a command and block until the device responds with a JSON line.
+        Lines that arrive while no request is waiting are discarded, and so are
+        lines missing any of expected_keys, so a late or unsolicited line is not
+        taken as the response.
+        Returns the parsed response, or None on timeout.
+        """
+        with self._request_lock:
+            with self._response_lock:
+                self._response = None
+                self._expected_keys = tuple(expected_keys)
+                self._response_ready.clear()
+            self.send_json_fire_and_forget(data)
+            received = self._response_ready.wait(timeout)
+            with self._response_lock:
+                self._expected_keys = None
+                response = self._response
+            if not received:
+                self.logger.log.error(f"No response to JSON command: {data}")
+                return None
+            self.logger.log.debug(f"Command response: {response}")
+            return response
+
+    def _enqueue(self, payload, coalesce_key=None, sent_values=()):
+        # Commands are never dropped. A queued command with the same coalesce_key
+        # is replaced by the newer one, as only the latest one matters. Otherwise
+        # wait until the writer thread has made room in the queue.
+        with self._outgoing_cond:
+            if coalesce_key is not None:
+                for item in self._outgoing:
+                    if item[0] == coalesce_key:
+                        self._outgoing.remove(item)
+                        break
+            self._outgoing_cond.wait_for(
+                lambda: self._closing or len(self._outgoing) < self.OUTGOING_MAX
+            )
+            if self._closing:
+                raise serial.SerialException("Rover connection is closed")
+            item = (coalesce_key, payload, sent_values)
+            self._outgoing.append(item)
+            for key, value in sent_values:
+                self._pending[key] = (item, value)
+            self._outgoing_cond.notify_all()
+
+    def _write_loop(self):
+        # Coalesce everything already queued (up to WRITE_BATCH_BYTES) into a
+        # single write, instead of one write per command. Each payload already
+        # ends with a newline.
+        # On close, keep writing until the queue is empty.
+        while True:
+            with self._outgoing_cond:
+                self._outgoing_cond.wait_for(lambda: self._outgoing or self._closing)
+                if not self._outgoing:
+                    return
+                items = []
+                size = 0
+                while self._outgoing and size < self.WRITE_BATCH_BYTES:
+                    item = self._outgoing.popleft()
+                    items.append(item)
+                    size += len(item[1])
+                self._outgoing_cond.notify_all()
+            try:
+                self.ser.write(b"".join(item[1] for item in items))
+            except (serial.SerialException, OSError) as e:
+                self.logger.log.error(f"Could not write to serial port: {e}")
+                # Fail any waiting and future commands instead of losing them silently
+                with self._outgoing_cond:
+                    self._closing = True
+                    self._outgoing.clear()
+                    self._last.clear()
+                    self._pending.clear()
+                    self._outgoing_cond.notify_all()
+                return
+            with self._outgoing_cond:
+                for item in items:
+                    for key, value in item[2]:
+                        self._last[key] = value
+                        if self._pending.get(key, (None,))[0] is item:
+                            del self._pending[key]
+
+    def _read_loop(self):
+        # Wait for the serial fd to become readable (epoll on Linux) and handle
+        # each complete line as soon as it arrives, instead of sleeping and
+        # polling for a response.
+        fd = self.ser.fileno()
+        selector = selectors.DefaultSelector()
+        selector.register(fd, selectors.EVENT_READ)
+        buffer = b""
+        while not self._closing:
+            try:
+                if not selector.select(timeout=0.1):
+                    continue
+                chunk = os.read(fd, 4096)
+            except BlockingIOError:
+                continue
+            except (OSError, ValueError) as e:
+                if not self._closing:
+                    self.logger.log.error(f"Could not read from serial port: {e}")
+                break
+            # Readable but no data means the device hung up (e.g. USB unplugged)
+            if not chunk:
+                self.logger.log.error(
+                    "Serial port returned no data, device disconnected"
+                )
+                break
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                self._handle_response(line.strip())
+        selector.close()
+
+    def _handle_response(self, response):
+        if not response:
+            return
+        try:
+            response_json = orjson.loads(response)
+        except orjson.JSONDecodeError:
+            self.logger.log.error(
+                f"Could not parse JSON response: {response.decode(errors='replace')}"
+            )
+            return
+        with self._response_lock:
+            if (
+                self._expected_keys is None
+                or self._response_ready.is_set()
+                or not isinstance(response_json, dict)
+                or any(key not in response_json for key in self._expected_keys)
+            ):
+                self.logger.log.debug(
+                    f"Discarding unrequested response: {response_json}"
+                )
+                return
+            self._response = response_json
+            self._response_ready.set()
 
     def oled_set(self, line, text):
         if len(text) > 22:
             text = text[:22]
-        command = {"T": 3, "lineNum": line, "Text": text}
-        self.send_json(command)
+        if self._last_value(("oled", line)) == text:
+            return
+        self.send_bytes_fire_and_forget(
+            self._tmpl_oled % (line, orjson.dumps(text)),
+            sent_values=((("oled", line), text),),
+        )
 
     def oled_clear(self):
-        for line in range(4):
-            command = {"T": 3, "lineNum": line, "Text": ""}
-            self.send_json(command)
+        self.send_bytes_fire_and_forget(
+            self._oled_clear_bytes,
+            sent_values=tuple((("oled", line), "") for line in range(4)),
+        )
 
     def oled_default(self):
         OLED_DEFAULT = {"T": -3}
-        self.send_json(OLED_DEFAULT)
+        self.send_json_fire_and_forget(
+            OLED_DEFAULT, sent_values=tuple((("oled", line), None) for line in range(4))
+        )
 
     def rover_exit(self):
         if self.ser.isOpen():
@@ -141,7 +333,7 @@ class Rover:
         I: Integral gain
         """
         PID_SET = {"T": 2, "P": P, "I": I}
-        self.send_json(PID_SET)
+        self.send_json_fire_and_forget(PID_SET)
 
     def speed_input(self, speed_left, speed_right):
         """
@@ -149,23 +341,51 @@ class Rover:
         speed_left: -255 ... 255
         speed_right: -255 ... 255
         """
-        SPEED_INPUT = {"T": 1, "L": speed_left, "R": speed_right}
-        self.send_json(SPEED_INPUT)
+        last = self._last_value("speed")
+        # Always send a stop, even if it is within the deadband of the last speed
+        if (
+            last is not None
+            and abs(speed_left - last[0]) <= self.SPEED_DEADBAND
+            and abs(speed_right - last[1]) <= self.SPEED_DEADBAND
+            and ((speed_left, speed_right) != (0, 0) or last == (0, 0))
+        ):
+            return
+        if type(speed_left) is int and type(speed_right) is int:
+            payload = self._tmpl_speed % (speed_left, speed_right)
+        else:
+            SPEED_INPUT = {"T": 1, "L": speed_left, "R": speed_right}
+            payload = orjson.dumps(SPEED_INPUT, option=orjson.OPT_APPEND_NEWLINE)
+        self.send_bytes_fire_and_forget(
+            payload,
+            coalesce_key="speed",
+            sent_values=(("speed", (speed_left, speed_right)),),
+        )
 
     def emergency_stop(self):
         EMERGENCY_STOP = {"T": 0}
-        self.send_json(EMERGENCY_STOP)
+        self.send_json_fire_and_forget(EMERGENCY_STOP, sent_values=(("speed", None),))
 
     def pwm_servo_control(self, position, speed):
-        PWM_SERVO_CTRL = {"T": 40, "pos": position, "spd": speed}
-        self.send_json(PWM_SERVO_CTRL)
+        if self._last_value("pwm_servo") == (position, speed):
+            return
+        if type(position) is int and type(speed) is int:
+            payload = self._tmpl_pwm_servo % (position, speed)
+        else:
+            PWM_SERVO_CTRL = {"T": 40, "pos": position, "spd": speed}
+            payload = orjson.dumps(PWM_SERVO_CTRL, option=orjson.OPT_APPEND_NEWLINE)
+        self.send_bytes_fire_and_forget(
+            payload,
+            sent_values=(("pwm_servo", (position, speed)),),
+        )
 
     def pwm_servo_mid(self):
         """
         The PWM servo is turned to the center position, which is the 90° position.
         """
         PWM_SERVO_MID = {"T": -4}
-        self.send_json(PWM_SERVO_MID)
+        self.send_json_fire_and_forget(
+            PWM_SERVO_MID, sent_values=(("pwm_servo", None),)
+        )
 
     def bus_servo_ctrl(self, servo_id, position, speed, acceleration):
         """
@@ -186,14 +406,14 @@ class Rover:
             "spd": speed,
             "acc": acceleration,
         }
-        self.send_json(BUS_SERVO_CTRL)
+        self.send_json_fire_and_forget(BUS_SERVO_CTRL)
 
     def bus_servo_mid(self, servo_id):
         """
         The bus servo is turned to the center position, which is the 90° position.
         """
         BUS_SERVO_MID = {"T": -5, "id": servo_id}
-        self.send_json(BUS_SERVO_MID)
+        self.send_json_fire_and_forget(BUS_SERVO_MID)
 
     def bus_servo_scan(self, number):
         """
@@ -202,18 +422,14 @@ class Rover:
         number: Maximum ID of the servo. The larger the value, the longer the scanning time.
         """
         BUS_SERVO_SCAN: {"T": 52, "num": number}
-        self.send_json(BUS_SERVO_SCAN)
-        # data = self.read_data()
-        # print(f"Bus servo: {data}")
+        self.send_json_fire_and_forget(BUS_SERVO_SCAN)
 
     def bus_servo_info(self, servo_id):
         """
         It is used to get the information feedback of a particular servo, which contains the position, speed, voltage, torque, and other information of the servo.
         """
         BUS_SERVO_INFO: {"T": 53, "id": servo_id}
-        self.send_json(BUS_SERVO_INFO)
-        # data = self.read_data()
-        # print(f"Bus servo: {data}")
+        self.send_json_fire_and_forget(BUS_SERVO_INFO)
 
     def bus_servo_id_set(self, old_id, new_id):
         """
@@ -224,7 +440,7 @@ class Rover:
         new: New ID to be set
         """
         BUS_SERVO_ID_SET: {"T": 54, "old": old_id, "new": new_id}
-        self.send_json(BUS_SERVO_ID_SET)
+        self.send_json_fire_and_forget(BUS_SERVO_ID_SET)
 
     def bus_servo_torque_lock(self, servo_id, status):
         """
@@ -235,7 +451,7 @@ class Rover:
         status: parameter of torque lock switch, 1 is to enable torque lock, the servo will keep its position; 0 is to disable torque lock, the servo will rotate under external force.
         """
         BUS_SERVO_TORQUE_LOCK: {"T": 55, "id": servo_id, "status": status}
-        self.send_json(BUS_SERVO_TORQUE_LOCK)
+        self.send_json_fire_and_forget(BUS_SERVO_TORQUE_LOCK)
 
     def bus_servo_torque_limit(self, servo_id, limit):
         """
@@ -246,7 +462,7 @@ class Rover:
         limit: Torque limiting ratio, 500 is 50%* locked rotor torque, 1000 is 100%* locked rotor torque, after limiting the torque, when the servo is subjected to external force when the torque of the external force is greater than the limiting torque, the servo will rotate with the external force, but it will still provide this torque, this function can be used to design the clamp of the robotic arm.
         """
         BUS_SERVO_TORQUE_LIMIT: {"T": 56, "servo_id": 1, "limit": limit}
-        self.send_json(BUS_SERVO_TORQUE_LIMIT)
+        self.send_json_fire_and_forget(BUS_SERVO_TORQUE_LIMIT)
 
     def bus_servo_mode(self, servo_id, mode):
         """
@@ -255,21 +471,21 @@ class Rover:
         mode: operation mode value, 0: position servo mode, used to control the absolute angle of the servo; 3: stepper servo mode, also use the BUS_SERVO_CTRL command to control the servo.
         """
         BUS_SERVO_MODE = {"T": 57, "id": servo_id, "mode": mode}
-        self.send_json(BUS_SERVO_MODE)
+        self.send_json_fire_and_forget(BUS_SERVO_MODE)
 
     def wifi_scan(self):
         """
         WIFI scanning command, which disconnects the existing WIFI connection to scan for surrounding WIFI hotspots.
         """
         WIFI_SCAN = {"T": 60}
-        self.send_json(WIFI_SCAN)
+        self.send_json_fire_and_forget(WIFI_SCAN)
 
     def wifi_try_sta(self):
         """
         WIFI connection command, STA mode, for connecting to a known WIFI.
         """
         WIFI_TRY_STA = {"T": 61}
-        self.send_json(WIFI_TRY_STA)
+        self.send_json_fire_and_forget(WIFI_TRY_STA)
 
     def wifi_ap_default(self):
         """
@@ -278,14 +494,14 @@ class Rover:
         Hotspot Password: 12345678
         """
         WIFI_AP_DEFAULT = {"T": 62}
-        self.send_json(WIFI_AP_DEFAULT)
+        self.send_json_fire_and_forget(WIFI_AP_DEFAULT)
 
     def wifi_info(self):
         """
         For obtaining WIFI information.
         """
         WIFI_INFO = {"T": 65}
-        data = self.send_json(WIFI_INFO, wait_for_response=True)
+        data = self.send_json_request(WIFI_INFO)
         self.logger.log.debug(f"Wifi info: {data}")
 
     def wifi_off(self):
@@ -293,25 +509,24 @@ class Rover:
         Disable the WiFi function.
         """
         WIFI_OFF = {"T": 66}
-        self.send_json(WIFI_OFF)
+        self.send_json_fire_and_forget(WIFI_OFF)
 
     def ina219_info(self):
         """
         Get information about the INA219, including the voltage and current power of the power supply.
         """
         INA219_INFO = {"T": 70}
-        info = self.send_json(INA219_INFO, wait_for_response=True)
+        INA219_FIELDS = ("shunt_mV", "load_V", "bus_V", "current_mA", "power_mW")
+        info = self.send_json_request(INA219_INFO, expected_keys=INA219_FIELDS)
 
-        # make sure no property is None
-        for key in info:
-            if info[key] is None:
-                info[key] = 0
+        if info is None:
+            self.logger.log.error("Could not get INA219 data")
+            return
 
-        shunt_voltage = info["shunt_mV"]
-        load_voltage = info["load_V"]
-        bus_voltage = info["bus_V"]
-        current = info["current_mA"]
-        power = info["power_mW"]
+        # Read all fields in one pass, treating missing or None values as 0
+        values = tuple(info.get(key) or 0 for key in INA219_FIELDS)
+        shunt_voltage, load_voltage, bus_voltage, current, power = values
+        info = dict(zip(INA219_FIELDS, values))
 
         self.get_rover_power_state(info)
 
@@ -333,13 +548,13 @@ class Rover:
         Used to obtain IMU information, including heading angle, geomagnetic field, acceleration, attitude, temperature, etc.
         """
         IMU_INFO = {"T": 71}
-        data = self.send_json(IMU_INFO, wait_for_response=True)
+        data = self.send_json_request(IMU_INFO, expected_keys=("roll", "pitch", "yaw"))
 
         if data is None:
             self.logger.log.error("Could not get IMU data")
             return
         if isinstance(data, str):
-            data = json.loads(data)
+            data = orjson.loads(data)
 
         temp = data["temp"]
         roll = data["roll"]
@@ -376,14 +591,14 @@ class Rover:
         Used to get motor encoder information. (Not applicable to WAVE ROVER as there are no encoders).
         """
         ENCODER_INFO = {"T": 73}
-        self.send_json(ENCODER_INFO)
+        self.send_json_fire_and_forget(ENCODER_INFO)
 
     def device_info(self):
         """
         Used to get the device information, the device information is required to be customized by the user, used to introduce the use of this device or other information.
         """
         DEVICE_INFO = {"T": 74}
-        data = self.send_json(DEVICE_INFO, wait_for_response=True)
+        data = self.send_json_request(DEVICE_INFO)
         self.logger.log.debug(f"Device info: {data}")
         return data
 
@@ -392,7 +607,7 @@ class Rover:
         It is used to control the high and low levels of the IO5 pin on top of the driver board, which can be used to control the night vision function switch of the infrared camera or to control the relay.
         """
         IO_IR_CUT = {"T": 80, "status": status}
-        self.send_json(IO_IR_CUT)
+        self.send_json_fire_and_forget(IO_IR_CUT)
 
     def set_spd_rate(self, L, R):
         """
@@ -401,14 +616,14 @@ class Rover:
         R: The power coefficient of the right side motor.
         """
         SET_SPD_RATE = {"T": 901, "L": L, "R": R}
-        self.send_json(SET_SPD_RATE)
+        self.send_json_fire_and_forget(SET_SPD_RATE)
 
     def get_spd_rate(self):
         """
         Get the power coefficients of the left and right side motors.
         """
         GET_SPD_RATE = {"T": 902}
-        data = self.send_json(GET_SPD_RATE, wait_for_response=True)
+        data = self.send_json_request(GET_SPD_RATE)
         self.logger.log.debug(f"Speed rate: {data}")
 
     def spd_rate_save(self):
@@ -416,14 +631,14 @@ class Rover:
         Saving the power coefficient of the motor will be saved in the nvs area of the ESP32 and will not be lost after power down, and this speed coefficient will be read and loaded by the nvs area after power up.
         """
         SPD_RATE_SAVE = {"T": 903}
-        self.send_json(SPD_RATE_SAVE)
+        self.send_json_fire_and_forget(SPD_RATE_SAVE)
 
     def get_nvs_space(self):
         """
         Get the remaining space in the nvs area of ESP32.
         """
         GET_NVS_SPACE = {"T": 904}
-        data = self.send_json(GET_NVS_SPACE, wait_for_response=True)
+        data = self.send_json_request(GET_NVS_SPACE)
         self.logger.log.debug(f"Remaining nvs space: {data}")
 
     def nvs_clear(self):
@@ -431,7 +646,7 @@ class Rover:
         Clear nvs zone, this command deletes the entire contents of the nvs zone, and the speed coefficient changes back to the default value of 1.0.
         """
         NVS_CLEAR = {"T": 905}
-        self.send_json(NVS_CLEAR)
+        self.send_json_fire_and_forget(NVS_CLEAR)
 
     def get_rover_power_state(self, data):
         # THis doesnt work properly yet